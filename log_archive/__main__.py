@@ -2,30 +2,56 @@ from __future__ import annotations
 
 import argparse
 import sys
-from pathlib import Path
+from pathlib import Path, PurePosixPath
 import os
 import json
 import tarfile
 import time
 from datetime import datetime, timezone
-from typing import Iterable, List, Set, Any, Dict
+from typing import BinaryIO, Callable, Iterable, Iterator, List, Set, Any, Dict
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 import shutil
 import hashlib
+import itertools
 import subprocess
+import glob
+import gzip
+import io
+import re
+import stat
+from contextlib import nullcontext
 
 try:
-	import tomllib  # Python 3.11+
+	import zstandard  # optional: in-process zstd
 except ModuleNotFoundError:  # pragma: no cover
-	try:
-		import tomli as tomllib  # type: ignore
-	except ModuleNotFoundError:
-		tomllib = None  # type: ignore
+	zstandard = None  # type: ignore
+
+try:
+	from isal import igzip  # optional: faster in-process gzip
+except ModuleNotFoundError:  # pragma: no cover
+	igzip = None  # type: ignore
 
 
 ARCHIVE_PREFIX = "logs_archive_"
 DEFAULT_OUTPUT_DIR_NAME = "archives"
 AUDIT_LOG_NAME = "archive.log"
 MANIFEST_NAME = "manifest.json"
+# Block size for streaming tar writes (tarfile's default is 20 * 512 bytes)
+TAR_BUFSIZE = 1024 * 1024
+# Per-member read/copy buffer (tarfile's default is 16 KiB)
+COPY_BUFSIZE = 1024 * 1024
+# Output buffering between the compressor and the archive file
+COMPRESS_BUFSIZE = 256 * 1024
+# Walk top-level subdirectories concurrently only when there are more than this many
+PARALLEL_WALK_MIN_DIRS = 4
+# Read-ahead while archiving: how many upcoming files to read on background threads,
+# how many threads to use, and the largest file that is buffered in memory
+PREFETCH_FILES = 64
+PREFETCH_THREADS = 4
+PREFETCH_MAX_BYTES = 256 * 1024
+# Duplicate detection hashes this much from each end of a file before a full comparison
+DEDUP_PROBE_BYTES = 64 * 1024
 
 
 def parse_args(argv: List[str]) -> argparse.Namespace:
@@ -59,6 +85,8 @@ def parse_args(argv: List[str]) -> argparse.Namespace:
 	parser.add_argument("--compression", choices=["gzip", "zstd", "none"], default="gzip", help="Compression algorithm to use (default: gzip)")
 	parser.add_argument("--compress-level", type=int, help="Compression level (algorithm-specific). If omitted, uses tool default")
 	parser.add_argument("--threads", type=int, default=1, help="Compression threads (1 = single-thread; 0 = auto for external tools)")
+	parser.add_argument("--dedup", action="store_true", help="Store files with identical contents once, as hardlinks in the archive")
+	parser.add_argument("--verify", action="store_true", help="Re-read the archive after writing and check its member count")
 	parser.add_argument("--dry-run", action="store_true", help="Show planned actions without writing")
 	parser.add_argument("--verbose", action="store_true", help="Verbose console output")
 	# Integrity/security
@@ -92,12 +120,7 @@ def split_patterns(csv: str | None) -> List[str]:
 	return [p.strip() for p in csv.split(",") if p.strip()]
 
 
-def relative_str(path: Path, root: Path) -> str:
-	return str(path.relative_to(root))
-
-
-def compute_state(path: Path) -> Dict[str, Any]:
-	st = path.stat()
+def compute_state(st: os.stat_result) -> Dict[str, Any]:
 	return {
 		"size": int(st.st_size),
 		"mtime_ns": int(st.st_mtime_ns),
@@ -116,8 +139,11 @@ def load_manifest(path: Path) -> Dict[str, Dict[str, Any]]:
 
 
 def write_manifest(path: Path, mapping: Dict[str, Dict[str, Any]]) -> None:
-	with path.open("w", encoding="utf-8") as fh:
+	# Write to a sibling temp file and rename so a crash never leaves a truncated manifest
+	tmp_path = path.with_name(path.name + ".tmp")
+	with tmp_path.open("w", encoding="utf-8") as fh:
 		json.dump(mapping, fh, indent=2, sort_keys=True)
+	os.replace(tmp_path, path)
 
 
 def load_config(explicit_path: Path | None) -> Dict[str, Any]:
@@ -129,156 +155,614 @@ def load_config(explicit_path: Path | None) -> Dict[str, Any]:
 	3) $XDG_CONFIG_HOME/log-archive/config.toml
 	4) ~/.config/log-archive/config.toml
 	"""
-	paths: List[Path] = []
+	# Plain strings and os.path keep the common "no config file" case to a few stat calls
+	candidates: List[str] = []
 	if explicit_path:
-		paths.append(explicit_path)
+		candidates.append(str(explicit_path))
 	else:
 		env_path = os.environ.get("LOG_ARCHIVE_CONFIG")
 		if env_path:
-			paths.append(Path(env_path))
+			candidates.append(env_path)
 		xdg = os.environ.get("XDG_CONFIG_HOME")
 		if xdg:
-			paths.append(Path(xdg) / "log-archive" / "config.toml")
-		paths.append(Path.home() / ".config" / "log-archive" / "config.toml")
+			candidates.append(os.path.join(xdg, "log-archive", "config.toml"))
+		candidates.append(os.path.join(os.path.expanduser("~"), ".config", "log-archive", "config.toml"))
 
-	for p in paths:
-		if p and p.is_file():
-			if tomllib is None:
+	for p in candidates:
+		if not os.path.isfile(p):
+			continue
+		# Only pay for the TOML parser import when a config file actually exists
+		try:
+			import tomllib  # Python 3.11+
+		except ModuleNotFoundError:  # pragma: no cover
+			try:
+				import tomli as tomllib  # type: ignore
+			except ModuleNotFoundError:
+				return {}
+		with open(p, "rb") as fh:
+			try:
+				data = tomllib.load(fh)
+				d = data if isinstance(data, dict) else {}
+				return d
+			except Exception:
 				return {}
-			with p.open("rb") as fh:
-				try:
-					data = tomllib.load(fh)  # type: ignore[arg-type]
-					d = data if isinstance(data, dict) else {}
-					return d
-				except Exception:
-					return {}
 	return {}
 
 
-def should_exclude(path: Path, root: Path, builtin_exclusions: Set[Path], include_patterns: List[str], exclude_patterns: List[str]) -> bool:
-	# Built-in exclusions take precedence
-	for excl in builtin_exclusions:
+def _probe_digest(path: Path, size: int) -> bytes:
+	"""Hash the first and last DEDUP_PROBE_BYTES of a file (the whole file if it is small)."""
+	h = hashlib.blake2b()
+	with open(path, "rb") as fh:
+		h.update(fh.read(DEDUP_PROBE_BYTES))
+		if size > 2 * DEDUP_PROBE_BYTES:
+			fh.seek(size - DEDUP_PROBE_BYTES)
+		h.update(fh.read(DEDUP_PROBE_BYTES))
+	return h.digest()
+
+
+def _full_digest(path: Path, size: int) -> bytes:
+	h = hashlib.blake2b()
+	with open(path, "rb") as fh:
+		for chunk in iter(lambda: fh.read(COPY_BUFSIZE), b""):
+			h.update(chunk)
+	return h.digest()
+
+
+def _group_by_digest(paths: List[Path], size: int, digest: Callable[[Path, int], bytes]) -> List[List[Path]]:
+	"""Split ``paths`` into groups of two or more with equal digests, keeping input order."""
+	groups: Dict[bytes, List[Path]] = {}
+	for p in paths:
 		try:
-			path.relative_to(excl)
-			return True
-		except ValueError:
-			pass
+			groups.setdefault(digest(p, size), []).append(p)
+		except OSError:
+			# Unreadable here: leave it to the archiver to add (or report) normally
+			continue
+	return [g for g in groups.values() if len(g) > 1]
+
+
+# duplicate -> (original, duplicate's (size, mtime), original's (size, mtime)) when hashed
+Duplicates = Dict[Path, tuple[Path, tuple[int, float], tuple[int, float]]]
+
+
+def find_duplicates(files: List[Path]) -> Duplicates:
+	"""Map each file whose content repeats an earlier file in ``files`` to that earlier file.
 
-	rel = path.relative_to(root)
-	# Exclude patterns
-	for pat in exclude_patterns:
-		if rel.match(pat):
+	Candidates are narrowed by size, then by a hash of both ends of the file; files
+	larger than the probe are confirmed with a full hash before being treated as equal.
+	Files that are already hardlinks of each other are left to tarfile. Each pair
+	records the (size, mtime) both files had here, so that archiving can tell
+	whether either changed in the meantime.
+	"""
+	states: Dict[Path, tuple[int, float]] = {}
+	by_size: Dict[int, List[Path]] = {}
+	seen_inodes: Set[tuple[int, int]] = set()
+	for f in files:
+		try:
+			st = os.lstat(f)
+		except OSError:
+			continue
+		if not stat.S_ISREG(st.st_mode) or st.st_size == 0 or (st.st_dev, st.st_ino) in seen_inodes:
+			continue
+		seen_inodes.add((st.st_dev, st.st_ino))
+		# st_mtime (not st_mtime_ns): it is what TarFile.gettarinfo stores in TarInfo.mtime
+		states[f] = (st.st_size, st.st_mtime)
+		by_size.setdefault(st.st_size, []).append(f)
+
+	duplicates: Duplicates = {}
+	for size, group in by_size.items():
+		if len(group) < 2:
+			continue
+		for candidates in _group_by_digest(group, size, _probe_digest):
+			if size > 2 * DEDUP_PROBE_BYTES:
+				same_groups = _group_by_digest(candidates, size, _full_digest)
+			else:
+				same_groups = [candidates]
+			for same in same_groups:
+				original = same[0]
+				for dup in same[1:]:
+					duplicates[dup] = (original, states[dup], states[original])
+	return duplicates
+
+
+def _glob_bracket_regex(pat: str, i: int, j: int) -> str:
+	"""Translate the bracket expression ``pat[i:j]`` (between "[" and "]") into a regex.
+
+	This follows ``fnmatch.translate`` so ranges, negation and escaping behave exactly
+	as in ``PurePath.match``; the only addition is that the class never matches "/".
+	"""
+	stuff = pat[i:j]
+	if "-" not in stuff:
+		stuff = stuff.replace("\\", r"\\")
+	else:
+		chunks = []
+		k = i + 2 if pat[i] == "!" else i + 1
+		while True:
+			k = pat.find("-", k, j)
+			if k < 0:
+				break
+			chunks.append(pat[i:k])
+			i = k + 1
+			k = k + 3
+		chunk = pat[i:j]
+		if chunk:
+			chunks.append(chunk)
+		else:
+			chunks[-1] += "-"
+		# Remove empty (reversed) ranges, which are invalid in a regex
+		for k in range(len(chunks) - 1, 0, -1):
+			if chunks[k - 1][-1] > chunks[k][0]:
+				chunks[k - 1] = chunks[k - 1][:-1] + chunks[k][1:]
+				del chunks[k]
+		# Escape backslashes and literal hyphens; hyphens joining chunks form ranges
+		stuff = "-".join(c.replace("\\", r"\\").replace("-", r"\-") for c in chunks)
+	# Escape set operations (&&, ~~ and ||)
+	stuff = re.sub(r"([&~|])", r"\\\1", stuff)
+	if not stuff:
+		# Empty range: never matches
+		return "(?!)"
+	if stuff == "!":
+		# Negated empty range: any single character
+		return "[^/]"
+	if stuff[0] == "!":
+		return f"[^{stuff[1:]}/]"
+	if stuff[0] in ("^", "["):
+		stuff = "\\" + stuff
+	return f"(?!/)[{stuff}]"
+
+
+def _glob_component_regex(pat: str) -> str:
+	"""Translate one glob path component into a regex that never matches "/"."""
+	out: List[str] = []
+	i, n = 0, len(pat)
+	while i < n:
+		c = pat[i]
+		i += 1
+		if c == "*":
+			if not out or out[-1] != "[^/]*":
+				out.append("[^/]*")
+		elif c == "?":
+			out.append("[^/]")
+		elif c == "[":
+			j = i
+			if j < n and pat[j] == "!":
+				j += 1
+			if j < n and pat[j] == "]":
+				j += 1
+			while j < n and pat[j] != "]":
+				j += 1
+			if j >= n:
+				out.append("\\[")
+			else:
+				out.append(_glob_bracket_regex(pat, i, j))
+				i = j + 1
+		else:
+			out.append(re.escape(c))
+	return "".join(out)
+
+
+def compile_matcher(include_patterns: List[str], exclude_patterns: List[str]) -> Callable[[str], bool]:
+	"""Compile include/exclude globs into a predicate over relative POSIX path strings.
+
+	The predicate returns True when the path should be excluded. Patterns follow
+	``PurePath.match`` semantics: relative patterns match the trailing components
+	of the path and ``*`` never crosses a "/". A leading "/" anchors a pattern at
+	the log directory, so "/nginx/*.log" matches only files directly in nginx/.
+	"""
+	def combine(patterns: List[str]) -> "re.Pattern[str] | None":
+		alternatives = []
+		for pat in patterns:
+			pure = PurePosixPath(pat)
+			if pure.is_absolute():
+				alternatives.append("/".join(_glob_component_regex(part) for part in pure.parts[1:]))
+			else:
+				alternatives.append(r"(?s:.*/)?" + "/".join(_glob_component_regex(part) for part in pure.parts))
+		if not alternatives:
+			return None
+		return re.compile(r"(?:" + "|".join(alternatives) + r")\Z")
+
+	include_re = combine(include_patterns)
+	exclude_re = combine(exclude_patterns)
+	has_includes = bool(include_patterns)
+
+	def is_excluded(rel: str) -> bool:
+		if exclude_re is not None and exclude_re.match(rel):
 			return True
-	# Include patterns (if any were provided): if provided, only include if matches any include pattern
-	if include_patterns:
-		for pat in include_patterns:
-			if rel.match(pat):
-				return False
+		# If include patterns were provided, only include paths matching one of them
+		if has_includes:
+			return include_re is None or include_re.match(rel) is None
+		return False
+
+	return is_excluded
+
+
+def include_prefix(include_patterns: List[str]) -> List[str]:
+	"""Return the literal leading directories shared by all include patterns.
+
+	Only anchored patterns ("/access/*.log") constrain where matches can live;
+	relative ones match at any depth, so any of those disables pruning.
+	"""
+	prefix: List[str] | None = None
+	for pat in include_patterns:
+		pure = PurePosixPath(pat)
+		if not pure.is_absolute():
+			return []
+		dirs = list(pure.parts[1:-1])
+		literal = list(itertools.takewhile(lambda part: not glob.has_magic(part) and part != "..", dirs))
+		if prefix is None:
+			prefix = literal
+		else:
+			common = 0
+			while common < min(len(prefix), len(literal)) and prefix[common] == literal[common]:
+				common += 1
+			prefix = prefix[:common]
+		if not prefix:
+			return []
+	return prefix or []
+
+
+def should_exclude(path: str, rel: str, builtin_exclusions: tuple[str, ...], matcher: Callable[[str], bool]) -> bool:
+	# Built-in exclusions take precedence. Each carries a trailing separator so that
+	# "archives" does not also swallow a sibling such as "archives-old".
+	if path.startswith(builtin_exclusions) or path + os.sep in builtin_exclusions:
 		return True
-	return False
 
+	if os.sep != "/":
+		rel = rel.replace(os.sep, "/")
+	return matcher(rel)
 
-def enumerate_files(log_directory: Path, output_dir: Path, audit_log_path: Path, include_patterns: List[str], exclude_patterns: List[str]) -> List[Path]:
-	builtin_exclusions: Set[Path] = {output_dir, audit_log_path}
-	files: List[Path] = []
-	for path in log_directory.rglob("*"):
-		if path.is_dir():
-			# Skip excluded directories quickly
-			if should_exclude(path, log_directory, builtin_exclusions, include_patterns, exclude_patterns):
+
+def _scan_dir(path: str, skip_dirs: Set[str]) -> tuple[List[os.DirEntry], List[str]]:
+	"""List one directory, returning its non-directory entries and the subdirectories to descend.
+
+	Directories in ``skip_dirs`` are pruned without being listed. Like ``Path.rglob``,
+	symlinked directories are not followed and unreadable directories are skipped.
+	"""
+	files: List[os.DirEntry] = []
+	subdirs: List[str] = []
+	try:
+		it = os.scandir(path)
+	except PermissionError:
+		return files, subdirs
+	with it:
+		for entry in it:
+			if entry.is_dir():
+				if not entry.is_symlink() and entry.path not in skip_dirs:
+					subdirs.append(entry.path)
 				continue
+			files.append(entry)
+	return files, subdirs
+
+
+def _walk_files(root: str, skip_dirs: Set[str]) -> Iterator[os.DirEntry]:
+	"""Yield non-directory entries under ``root`` with one scandir call per directory."""
+	pending = deque([root])
+	while pending:
+		files, subdirs = _scan_dir(pending.pop(), skip_dirs)
+		yield from files
+		pending.extend(subdirs)
+
+
+def _walk_files_parallel(root: str, skip_dirs: Set[str]) -> Iterator[os.DirEntry]:
+	"""Like ``_walk_files``, but walks top-level subdirectories on a thread pool.
+
+	Small trees are walked serially to avoid paying for threads that cannot help.
+	"""
+	files, subdirs = _scan_dir(root, skip_dirs)
+	yield from files
+	if len(subdirs) <= PARALLEL_WALK_MIN_DIRS:
+		for d in subdirs:
+			yield from _walk_files(d, skip_dirs)
+		return
+	with ThreadPoolExecutor(max_workers=min(len(subdirs), os.cpu_count() or 1)) as pool:
+		for entries in pool.map(lambda d: list(_walk_files(d, skip_dirs)), subdirs):
+			yield from entries
+
+
+def enumerate_files(
+	log_directory: Path,
+	output_dir: Path,
+	audit_log_path: Path,
+	include_patterns: List[str],
+	exclude_patterns: List[str],
+	previous: Dict[str, Dict[str, Any]] | None = None,
+	current: Dict[str, Dict[str, Any]] | None = None,
+) -> List[Path]:
+	"""Return the files under ``log_directory`` selected for archiving.
+
+	When ``current`` is given, it is filled with the manifest state of every selected
+	file. When ``previous`` is given, files whose state is unchanged are skipped.
+	"""
+	root = str(log_directory)
+	# Every walked path starts with this prefix, so relative paths are plain slices
+	root_prefix = root if root.endswith(os.sep) else root + os.sep
+	builtin_exclusions = tuple(str(p) + os.sep for p in (output_dir, audit_log_path))
+	matcher = compile_matcher(include_patterns, exclude_patterns)
+	want_state = previous is not None or current is not None
+	files: List[Path] = []
+	# Start below any literal directory prefix shared by anchored include patterns;
+	# like the walk itself, do not follow symlinked directories on the way down
+	walk_root = root
+	for part in include_prefix(include_patterns):
+		walk_root = os.path.join(walk_root, part)
+		if os.path.islink(walk_root) or not os.path.isdir(walk_root):
+			return files
+	# The output directory is pruned during the walk; should_exclude still guards the audit log
+	for entry in _walk_files_parallel(walk_root, {str(output_dir)}):
+		rel = entry.path[len(root_prefix):]
+		if should_exclude(entry.path, rel, builtin_exclusions, matcher):
 			continue
-		if should_exclude(path, log_directory, builtin_exclusions, include_patterns, exclude_patterns):
-			continue
-		files.append(path)
+		if want_state:
+			try:
+				state = compute_state(entry.stat())
+			except OSError:
+				# e.g. a dangling symlink: archive it, but do not record it
+				files.append(Path(entry.path))
+				continue
+			if current is not None:
+				current[rel] = state
+			if previous is not None and previous.get(rel) == state:
+				continue
+		files.append(Path(entry.path))
 	return files
 
 
-def create_archive(source_root: Path, files: Iterable[Path], dest_archive: Path, compression: str, level: int | None, threads: int, verbose: bool) -> int:
+def _open_compressor(fh: BinaryIO, compression: str, level: int | None, threads: int) -> BinaryIO:
+	"""Wrap a binary output handle in a streaming compressor for ``compression``.
+
+	Closing the returned stream flushes the compressor but leaves ``fh`` open.
+	"""
+	if compression == "zstd":
+		cctx = zstandard.ZstdCompressor(
+			level=3 if level is None else level,
+			threads=-1 if threads == 0 else threads,
+		)
+		return cctx.stream_writer(fh, write_size=COMPRESS_BUFSIZE, closefd=False)  # type: ignore[return-value]
+	if compression == "gzip":
+		# python-isal only supports levels 0-3; use stdlib gzip for explicit levels
+		if igzip is not None and level is None:
+			return igzip.IGzipFile(fileobj=fh, mode="wb")  # type: ignore[return-value]
+		return gzip.GzipFile(fileobj=fh, mode="wb", compresslevel=9 if level is None else level)  # type: ignore[return-value]
+	return fh
+
+
+def _prefetch(path: Path) -> bytes | None:
+	"""Read a small regular file into memory, or return None to let tarfile stream it."""
+	try:
+		st = os.lstat(path)
+		if not stat.S_ISREG(st.st_mode) or st.st_size > PREFETCH_MAX_BYTES:
+			return None
+		with open(path, "rb") as fh:
+			return fh.read()
+	except OSError:
+		# Let the archiving thread hit (and report) the error itself
+		return None
+
+
+def _duplicate_linker(source_root: Path, duplicates: Duplicates | None) -> Callable[[tarfile.TarInfo, Path], None]:
+	"""Return a callback that turns regular-file members into hardlinks to their earlier copy.
+
+	Live logs can change between ``find_duplicates`` and archiving, so a member is
+	only linked when it still has the hashed (size, mtime) and its original was
+	archived as a regular member with its own hashed state; otherwise it is stored
+	in full.
+	"""
+	duplicates = duplicates or {}
+	originals = {original: state for original, _, state in duplicates.values()}
+	archived_unchanged: Set[Path] = set()
+
+	def link(tarinfo: tarfile.TarInfo, f: Path) -> None:
+		if not duplicates or not tarinfo.isreg():
+			return
+		state = (tarinfo.size, tarinfo.mtime)
+		if originals.get(f) == state:
+			archived_unchanged.add(f)
+		entry = duplicates.get(f)
+		if entry is None:
+			return
+		original, dup_state, _ = entry
+		if state == dup_state and original in archived_unchanged:
+			tarinfo.type = tarfile.LNKTYPE
+			tarinfo.linkname = str(original.relative_to(source_root))
+			tarinfo.size = 0
+
+	return link
+
+
+def _write_tar_stream(stream: BinaryIO, source_root: Path, files: Iterable[Path], duplicates: Duplicates | None = None) -> int:
+	"""Write ``files`` as a streaming (non-seeking) tar into ``stream``; return the member count.
+
+	Small files are read ahead on a thread pool so that file I/O overlaps with
+	compression; everything else is streamed from disk as ``TarFile.add`` would.
+	Files in ``duplicates`` are stored as hardlinks to their earlier copy while unchanged.
+	"""
+	count = 0
+	link_duplicate = _duplicate_linker(source_root, duplicates)
+	files_iter = iter(files)
+	with tarfile.open(fileobj=stream, mode="w|", bufsize=TAR_BUFSIZE, copybufsize=COPY_BUFSIZE) as tar, \
+			ThreadPoolExecutor(max_workers=PREFETCH_THREADS) as pool:
+		pending: deque = deque((f, pool.submit(_prefetch, f)) for f in itertools.islice(files_iter, PREFETCH_FILES))
+		while pending:
+			f, fut = pending.popleft()
+			nxt = next(files_iter, None)
+			if nxt is not None:
+				pending.append((nxt, pool.submit(_prefetch, nxt)))
+			data = fut.result()
+			tarinfo = tar.gettarinfo(f, arcname=str(f.relative_to(source_root)))
+			if tarinfo is None:
+				# Sockets and other unsupported types are skipped, as TarFile.add does
+				continue
+			link_duplicate(tarinfo, f)
+			if not tarinfo.isreg():
+				tar.addfile(tarinfo)
+			elif data is not None and len(data) == tarinfo.size:
+				tar.addfile(tarinfo, io.BytesIO(data))
+			else:
+				with open(f, "rb") as fh:
+					tar.addfile(tarinfo, fh)
+			count += 1
+	return count
+
+
+def _sendfile_all(out_fd: int, src_fd: int, size: int) -> None:
+	offset = 0
+	while offset < size:
+		sent = os.sendfile(out_fd, src_fd, offset, size - offset)
+		if sent == 0:
+			raise OSError("unexpected end of data")
+		offset += sent
+
+
+def _write_tar_sendfile(out: BinaryIO, source_root: Path, files: Iterable[Path], duplicates: Duplicates | None = None) -> int:
+	"""Write an uncompressed tar into ``out``, copying file contents in-kernel with os.sendfile.
+
+	Headers are produced by tarfile itself (``gettarinfo``/``tobuf``), so the result
+	is identical to what ``TarFile.add`` writes; only the data copy bypasses Python.
+	"""
+	count = 0
+	written = 0
+	link_duplicate = _duplicate_linker(source_root, duplicates)
+	out_fd = out.fileno()
+	# A TarFile over a scratch buffer supplies gettarinfo(): owner names and hardlink tracking
+	with tarfile.open(fileobj=io.BytesIO(), mode="w") as helper:
+		for f in files:
+			tarinfo = helper.gettarinfo(f, arcname=str(f.relative_to(source_root)))
+			if tarinfo is None:
+				continue
+			link_duplicate(tarinfo, f)
+			written += out.write(tarinfo.tobuf(helper.format, helper.encoding, helper.errors))
+			if tarinfo.isreg() and tarinfo.size:
+				out.flush()
+				with open(f, "rb") as src:
+					_sendfile_all(out_fd, src.fileno(), tarinfo.size)
+				blocks, remainder = divmod(tarinfo.size, tarfile.BLOCKSIZE)
+				if remainder:
+					out.write(tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
+					blocks += 1
+				written += blocks * tarfile.BLOCKSIZE
+			count += 1
+	# End-of-archive marker, padded to a full record like TarFile.close()
+	written += out.write(tarfile.NUL * (2 * tarfile.BLOCKSIZE))
+	remainder = written % tarfile.RECORDSIZE
+	if remainder:
+		out.write(tarfile.NUL * (tarfile.RECORDSIZE - remainder))
+	return count
+
+
+def _external_compressor(compression: str, level: int | None, threads: int) -> List[str] | None:
+	"""Return a command that compresses stdin to stdout, or None to compress in-process."""
+	if compression == "gzip" and threads != 1:
+		exe = shutil.which("pigz")
+		if exe is None:
+			# No parallel gzip available: fall back to single-threaded isal/stdlib gzip
+			return None
+		cmd = [exe, "-c"]
+		if threads > 0:
+			cmd += ["-p", str(threads)]
+	elif compression == "zstd" and zstandard is None:
+		exe = shutil.which("zstd") or "zstd"
+		cmd = [exe, "-q", "-c"]
+		if threads >= 0:
+			cmd += ["-T" + str(threads)]
+	else:
+		return None
+	if level is not None:
+		cmd += [f"-{level}"]
+	return cmd
+
+
+def create_archive(source_root: Path, files: Iterable[Path], dest_archive: Path, compression: str, level: int | None, threads: int, verbose: bool, duplicates: Duplicates | None = None) -> tuple[int, int, int]:
+	"""Create ``dest_archive`` from ``files``; return ``(duration_ms, file_count, size_bytes)``.
+
+	``duplicates`` (see ``find_duplicates``) maps files to an earlier identical file;
+	those are stored as hardlink members instead of repeating their contents, unless
+	either file changed since it was hashed.
+	"""
 	start = time.perf_counter()
 	# Strategy:
-	# - gzip: use Python tarfile for simple case; otherwise create .tar then use pigz/gzip
-	# - zstd: create .tar then compress with zstd
-	# - none: create plain .tar
-
-	if compression == "gzip" and threads == 1 and level is None:
-		with tarfile.open(dest_archive, mode="w:gz") as tar:
-			for f in files:
-				arcname = f.relative_to(source_root)
-				tar.add(f, arcname=str(arcname), recursive=False)
-	else:
-		# Create uncompressed tar, then compress with external tool
-		tmp_tar = dest_archive
-		# Remove compressed suffix if present (e.g., .gz/.zst)
-		if tmp_tar.suffix in {".gz", ".zst"}:
-			tmp_tar = tmp_tar.with_suffix("")
-		# Ensure .tar suffix
-		if tmp_tar.suffix != ".tar":
-			tmp_tar = tmp_tar.with_suffix(".tar")
-		with tarfile.open(tmp_tar, mode="w") as tar:
-			for f in files:
-				arcname = f.relative_to(source_root)
-				tar.add(f, arcname=str(arcname), recursive=False)
-
-		if compression == "gzip":
-			exe = shutil.which("pigz") if threads != 1 else shutil.which("gzip")
-			if exe is None:
-				exe = "pigz" if threads != 1 else "gzip"
-			cmd = [exe]
-			if threads != 1 and exe.endswith("pigz"):
-				if threads > 0:
-					cmd += ["-p", str(threads)]
-			if level is not None:
-				cmd += [f"-{level}"]
-			cmd += [str(tmp_tar)]
-			if verbose:
-				print("Running:", " ".join(cmd))
-			subprocess.run(cmd, check=True)
-			# pigz/gzip replace .tar with .tar.gz
-			if dest_archive.suffix != ".gz":
-				# Ensure file ends up as dest_archive
-				produced = tmp_tar.with_suffix(tmp_tar.suffix + ".gz")
-				if produced != dest_archive:
-					produced.rename(dest_archive)
-		elif compression == "zstd":
-			exe = shutil.which("zstd") or "zstd"
-			cmd = [exe, "-q", "-f"]
-			if threads >= 0:
-				cmd += ["-T" + str(threads)]
-			if level is not None:
-				cmd += [f"-{level}"]
-			cmd += ["-o", str(dest_archive), str(tmp_tar)]
+	# - zstd: stream tar through zstandard (multithreaded via threads); without it, pipe into the zstd CLI
+	# - gzip: pipe tar into pigz when threads != 1, otherwise stream through isal/stdlib gzip
+	# - none: copy file contents into a plain .tar with sendfile on Linux, else stream it
+	cmd = _external_compressor(compression, level, threads)
+	with dest_archive.open("wb", buffering=COMPRESS_BUFSIZE) as raw:
+		if compression == "none" and sys.platform.startswith("linux"):
+			file_count = _write_tar_sendfile(raw, source_root, files, duplicates)
+		elif cmd is None:
+			# Plain tar writes straight into raw, which must stay open for the size below
+			compressor = nullcontext(raw) if compression == "none" else _open_compressor(raw, compression, level, threads)
+			with compressor as stream:
+				file_count = _write_tar_stream(stream, source_root, files, duplicates)
+		else:
 			if verbose:
 				print("Running:", " ".join(cmd))
-			subprocess.run(cmd, check=True)
-			tmp_tar.unlink(missing_ok=True)
-		elif compression == "none":
-			if tmp_tar != dest_archive:
-				tmp_tar.rename(dest_archive)
+			proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=raw)
+			try:
+				file_count = _write_tar_stream(proc.stdin, source_root, files, duplicates)  # type: ignore[arg-type]
+			finally:
+				proc.stdin.close()  # type: ignore[union-attr]
+				returncode = proc.wait()
+			if returncode != 0:
+				raise subprocess.CalledProcessError(returncode, cmd)
+		# Everything (ours or the external compressor's) has been written through this fd
+		raw.flush()
+		size_bytes = os.fstat(raw.fileno()).st_size
 
 	elapsed_ms = int((time.perf_counter() - start) * 1000)
-	return elapsed_ms
+	return elapsed_ms, file_count, size_bytes
+
+
+_SIZE_UNITS = ("B", "KB", "MB", "GB", "TB")
 
 
 def human_size(num_bytes: int) -> str:
-	units = ["B", "KB", "MB", "GB", "TB"]
-	size = float(num_bytes)
-	for unit in units:
-		if size < 1024.0 or unit == units[-1]:
-			return f"{size:.1f}{unit}"
-		size /= 1024.0
-	return f"{size:.1f}TB"
+	# Pick the unit from the bit length, then round to one decimal with integer math
+	# (half-to-even, matching the float formatting this replaced)
+	idx = min((num_bytes.bit_length() - 1) // 10, 4) if num_bytes > 0 else 0
+	shift = 10 * idx
+	tenths, rem = divmod(num_bytes * 10, 1 << shift)
+	if shift and (rem * 2 > (1 << shift) or (rem * 2 == (1 << shift) and tenths & 1)):
+		tenths += 1
+	return f"{tenths // 10}.{tenths % 10}{_SIZE_UNITS[idx]}"
 
 
 def compute_file_count_and_size(archive_path: Path) -> tuple[int, int]:
-	# Try to read members for gzip/bz2/xz/plain tar; zstd will fall back to count=0
+	# Verification helper: re-reads the whole archive, so keep it off the normal path.
+	# Reads gzip/bz2/xz/plain tar, and zstd via zstandard or the zstd CLI; otherwise count=0
 	try:
-		with tarfile.open(archive_path, mode="r:*") as tar:
-			count = sum(1 for _ in tar)
-			size = archive_path.stat().st_size
-			return count, size
+		if archive_path.name.endswith(".zst"):
+			if zstandard is not None:
+				with archive_path.open("rb") as fh, zstandard.ZstdDecompressor().stream_reader(fh) as reader:
+					with tarfile.open(fileobj=reader, mode="r|") as tar:
+						count = sum(1 for _ in tar)
+			else:
+				exe = shutil.which("zstd")
+				if exe is None:
+					raise tarfile.ReadError("neither zstandard nor the zstd CLI is available")
+				with subprocess.Popen([exe, "-q", "-d", "-c", str(archive_path)], stdout=subprocess.PIPE) as proc:
+					with tarfile.open(fileobj=proc.stdout, mode="r|") as tar:
+						count = sum(1 for _ in tar)
+				if proc.returncode != 0:
+					raise tarfile.ReadError(f"zstd exited with status {proc.returncode}")
+		else:
+			with tarfile.open(archive_path, mode="r:*") as tar:
+				count = sum(1 for _ in tar)
 	except tarfile.ReadError:
-		size = archive_path.stat().st_size
-		return 0, size
+		count = 0
+	return count, archive_path.stat().st_size
+
+
+def verify_archive(archive_path: Path, expected_count: int) -> bool:
+	"""Check that ``archive_path`` holds ``expected_count`` members.
+
+	Returns False (after a warning) when the archive cannot be read here, and
+	raises ValueError when it can be read but the count differs.
+	"""
+	if archive_path.name.endswith(".zst") and zstandard is None and shutil.which("zstd") is None:
+		print(f"Warning: cannot verify {archive_path}: needs zstandard or the zstd CLI", file=sys.stderr)
+		return False
+	count, _ = compute_file_count_and_size(archive_path)
+	if count != expected_count:
+		raise ValueError(f"verification failed: {archive_path} has {count} members, expected {expected_count}")
+	return True
 
 
 def write_sha256(archive_path: Path) -> Path:
@@ -317,37 +801,74 @@ def run_gpg_sign(src: Path, verbose: bool) -> Path:
 	return src.with_suffix(src.suffix + ".sig")
 
 
-def write_audit_line(audit_log_path: Path, now: datetime, archive_name: str, file_count: int, size_bytes: int, duration_ms: int, error: str | None = None) -> None:
-	iso = now.isoformat()
-	local_str = now.strftime("%Y-%m-%d %H:%M:%S")
-	if error:
-		line = f"{iso} | local={local_str} | archive={archive_name} | ERROR={error}\n"
-	else:
-		size_h = human_size(size_bytes)
-		line = (
-			f"{iso} | local={local_str} | archive={archive_name} | files={file_count} | "
-			f"size={size_h} | duration_ms={duration_ms}\n"
-		)
-	with audit_log_path.open("a", encoding="utf-8") as fh:
-		fh.write(line)
+class AuditLog:
+	"""Append-only handle on the audit log, opened once and synced on close.
 
+	Each entry is written with a single ``os.write`` on an ``O_APPEND`` descriptor,
+	so lines from concurrent runs never interleave.
+	"""
+
+	def __init__(self, path: Path) -> None:
+		flags = os.O_WRONLY | os.O_APPEND | os.O_CREAT | getattr(os, "O_CLOEXEC", 0)
+		self.path = path
+		self._fd = os.open(path, flags, 0o644)
+
+	def __enter__(self) -> "AuditLog":
+		return self
+
+	def __exit__(self, *exc_info: object) -> None:
+		self.close()
+
+	def write(self, now: datetime, archive_name: str, file_count: int, size_bytes: int, duration_ms: int, error: str | None = None) -> None:
+		stamp = f"{now.isoformat()} | local={now:%Y-%m-%d %H:%M:%S}"
+		if error:
+			line = f"{stamp} | archive={archive_name} | ERROR={error}\n"
+		else:
+			line = (
+				f"{stamp} | archive={archive_name} | files={file_count} | "
+				f"size={human_size(size_bytes)} | duration_ms={duration_ms}\n"
+			)
+		os.write(self._fd, line.encode("utf-8"))
+
+	def close(self) -> None:
+		if self._fd < 0:
+			return
+		try:
+			os.fsync(self._fd)
+		finally:
+			os.close(self._fd)
+			self._fd = -1
+
+
+def write_audit_line(audit_log_path: Path, now: datetime, archive_name: str, file_count: int, size_bytes: int, duration_ms: int, error: str | None = None) -> None:
+	with AuditLog(audit_log_path) as audit:
+		audit.write(now, archive_name, file_count, size_bytes, duration_ms, error=error)
 
 
 def apply_retention(output_dir: Path, retention_days: int | None, retention_count: int | None, dry_run: bool, verbose: bool) -> None:
-	# Match all supported extensions
-	archives = sorted(
-		[
-			p for p in output_dir.glob(f"{ARCHIVE_PREFIX}*.*")
-			if p.is_file() and (p.suffix in {".gz", ".zst", ""} or p.suffixes[-2:] in [[".tar", ".gz"], [".tar", ".zst"], [".tar"]])
-		],
-		key=lambda p: p.stat().st_mtime,
-	)
+	# Match all supported extensions; scandir caches each entry's stat, so mtime is read once
+	archives: List[tuple[float, Path]] = []
+	try:
+		it = os.scandir(output_dir)
+	except FileNotFoundError:
+		return
+	with it:
+		for entry in it:
+			if not (entry.name.startswith(ARCHIVE_PREFIX) and entry.name.endswith((".tar", ".gz", ".zst"))):
+				continue
+			try:
+				if entry.is_file():
+					archives.append((entry.stat().st_mtime, Path(entry.path)))
+			except FileNotFoundError:
+				# Removed between listing and stat (e.g. by a concurrent run); skip just this one
+				continue
+	archives.sort()
 	to_delete: List[Path] = []
 	if retention_days is not None:
 		cutoff = _now().timestamp() - (retention_days * 86400)
-		to_delete = [p for p in archives if p.stat().st_mtime < cutoff]
+		to_delete = [p for mtime, p in archives if mtime < cutoff]
 	elif retention_count is not None and len(archives) > retention_count:
-		to_delete = archives[:-retention_count]
+		to_delete = [p for _, p in archives[:-retention_count]]
 
 	for p in to_delete:
 		if verbose or dry_run:
@@ -359,6 +880,18 @@ def apply_retention(output_dir: Path, retention_days: int | None, retention_coun
 				print(f"Warning: failed to delete {p}: {exc}", file=sys.stderr)
 
 
+def apply_retention_in_background(output_dir: Path, retention_days: int | None, retention_count: int | None) -> Future[None]:
+	"""Start ``apply_retention`` on a worker thread.
+
+	Call ``result()`` on the returned future to wait for it and re-raise any error.
+	"""
+	executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="log-archive-retention")
+	future = executor.submit(apply_retention, output_dir, retention_days, retention_count, False, False)
+	# The submitted call still runs; this only stops the executor accepting more work
+	executor.shutdown(wait=False)
+	return future
+
+
 def main(argv: List[str] | None = None) -> int:
 	args = parse_args(argv or sys.argv[1:])
 	config = load_config(args.config)
@@ -399,21 +932,16 @@ def main(argv: List[str] | None = None) -> int:
 	archive_name = build_archive_name(now, args.compression)
 	archive_path = output_dir / archive_name
 
-	# Enumerate files to include
-	files = enumerate_files(log_dir, output_dir, audit_log_path, include_patterns, exclude_patterns)
-
-	# Incremental filtering using manifest
+	# Enumerate files to include; in incremental mode skip files unchanged since the manifest
 	manifest_path = args.manifest or (output_dir / MANIFEST_NAME)
-	manifest = load_manifest(manifest_path)
-	if args.incremental and manifest:
-		filtered: List[Path] = []
-		for f in files:
-			rel = relative_str(f, log_dir)
-			prev = manifest.get(rel)
-			cur = compute_state(f)
-			if prev != cur:
-				filtered.append(f)
-		files = filtered
+	new_manifest: Dict[str, Dict[str, Any]] = {}
+	if args.incremental:
+		files = enumerate_files(
+			log_dir, output_dir, audit_log_path, include_patterns, exclude_patterns,
+			previous=load_manifest(manifest_path), current=new_manifest,
+		)
+	else:
+		files = enumerate_files(log_dir, output_dir, audit_log_path, include_patterns, exclude_patterns)
 	if args.verbose:
 		print(f"Found {len(files)} files to archive")
 		for f in files[:50]:
@@ -437,56 +965,87 @@ def main(argv: List[str] | None = None) -> int:
 		return 0
 
 	try:
-		duration_ms = create_archive(log_dir, files, archive_path, args.compression, args.compress_level, args.threads, args.verbose)
-		file_count, size_bytes = compute_file_count_and_size(archive_path)
-		write_audit_line(audit_log_path, now, archive_name, file_count, size_bytes, duration_ms)
-		# Integrity: SHA256 checksum
-		sha_path: Path | None = None
-		if args.sha256:
-			sha_path = write_sha256(archive_path)
-			if args.verbose:
-				print(f"Wrote checksum {sha_path}")
-		# Security: GPG operations
-		if args.gpg_encrypt:
-			recipients = [r.strip() for r in (args.gpg_recipients or "").split(",") if r.strip()]
-			if not recipients:
-				raise ValueError("--gpg-encrypt requires --gpg-recipients")
-			archive_path = run_gpg_encrypt(archive_path, recipients, args.verbose)
-			archive_name = archive_path.name
-			# If we created a checksum for the plaintext, regenerate for the .gpg
-			if args.sha256:
-				sha_path = write_sha256(archive_path)
-				if args.verbose:
-					print(f"Wrote checksum {sha_path}")
-		if args.gpg_sign:
-			sig_path = run_gpg_sign(archive_path, args.verbose)
-			if args.verbose:
-				print(f"Wrote signature {sig_path}")
-		# Update manifest after successful archive
-		if args.incremental:
-			new_manifest: Dict[str, Dict[str, Any]] = {}
-			# Always rescan full set (not only archived files) to capture current state
-			for f in enumerate_files(log_dir, output_dir, audit_log_path, include_patterns, exclude_patterns):
-				rel = relative_str(f, log_dir)
-				new_manifest[rel] = compute_state(f)
-			write_manifest(manifest_path, new_manifest)
-		if args.verbose:
-			print(f"Created {archive_path} ({file_count} files, {human_size(size_bytes)}, {duration_ms} ms)")
-		# Apply retention policy after successful archive
-		apply_retention(output_dir, args.retention_days, args.retention_count, dry_run=False, verbose=args.verbose)
-		return 0
+		audit = AuditLog(audit_log_path)
 	except PermissionError as exc:
-		write_audit_line(audit_log_path, now, archive_name, 0, 0, 0, error=str(exc))
 		print(f"Permission error: {exc}", file=sys.stderr)
 		return 3
-	except Exception as exc:  # pragma: no cover
-		try:
-			write_audit_line(audit_log_path, now, archive_name, 0, 0, 0, error=str(exc))
-		except Exception:
-			pass
+	except OSError as exc:
 		print(f"Error: {exc}", file=sys.stderr)
 		return 1
 
+	with audit:
+		try:
+			duplicates: Duplicates | None = None
+			if args.dedup:
+				duplicates = find_duplicates(files)
+				if args.verbose:
+					print(f"Storing {len(duplicates)} duplicate files as hardlinks")
+			duration_ms, file_count, size_bytes = create_archive(
+				log_dir, files, archive_path, args.compression, args.compress_level, args.threads, args.verbose,
+				duplicates=duplicates,
+			)
+			if args.verify and verify_archive(archive_path, file_count) and args.verbose:
+				print(f"Verified {archive_path} ({file_count} members)")
+			audit.write(now, archive_name, file_count, size_bytes, duration_ms)
+			# Retention only touches older archives, so it can run on a worker while this one
+			# is checksummed/signed. It must not start before GPG encryption, which deletes the
+			# plaintext archive that the scan would otherwise count. Runs with nothing to
+			# overlap, and verbose runs (ordered output), stay synchronous.
+			wants_retention = args.retention_days is not None or args.retention_count is not None
+			background_retention = wants_retention and not args.verbose and (
+				args.gpg_sign or (args.sha256 and not args.gpg_encrypt)
+			)
+			retention: Future[None] | None = None
+			if background_retention and not args.gpg_encrypt:
+				retention = apply_retention_in_background(output_dir, args.retention_days, args.retention_count)
+			# Integrity: SHA256 checksum
+			sha_path: Path | None = None
+			if args.sha256:
+				sha_path = write_sha256(archive_path)
+				if args.verbose:
+					print(f"Wrote checksum {sha_path}")
+			# Security: GPG operations
+			if args.gpg_encrypt:
+				recipients = [r.strip() for r in (args.gpg_recipients or "").split(",") if r.strip()]
+				if not recipients:
+					raise ValueError("--gpg-encrypt requires --gpg-recipients")
+				archive_path = run_gpg_encrypt(archive_path, recipients, args.verbose)
+				archive_name = archive_path.name
+				# If we created a checksum for the plaintext, regenerate for the .gpg
+				if args.sha256:
+					sha_path = write_sha256(archive_path)
+					if args.verbose:
+						print(f"Wrote checksum {sha_path}")
+			if background_retention and retention is None:
+				retention = apply_retention_in_background(output_dir, args.retention_days, args.retention_count)
+			if args.gpg_sign:
+				sig_path = run_gpg_sign(archive_path, args.verbose)
+				if args.verbose:
+					print(f"Wrote signature {sig_path}")
+			# Update manifest after successful archive, recording the state seen at enumeration
+			# so that files modified while archiving are picked up by the next run
+			if args.incremental:
+				write_manifest(manifest_path, new_manifest)
+			if args.verbose:
+				print(f"Created {archive_path} ({file_count} files, {human_size(size_bytes)}, {duration_ms} ms)")
+			# Apply retention policy after successful archive, surfacing any failure
+			if retention is not None:
+				retention.result()
+			elif wants_retention:
+				apply_retention(output_dir, args.retention_days, args.retention_count, dry_run=False, verbose=args.verbose)
+			return 0
+		except PermissionError as exc:
+			audit.write(now, archive_name, 0, 0, 0, error=str(exc))
+			print(f"Permission error: {exc}", file=sys.stderr)
+			return 3
+		except Exception as exc:  # pragma: no cover
+			try:
+				audit.write(now, archive_name, 0, 0, 0, error=str(exc))
+			except Exception:
+				pass
+			print(f"Error: {exc}", file=sys.stderr)
+			return 1
+
 
 if __name__ == "__main__":
 	sys.exit(main())
@@ -1,5 +1,8 @@
 import os
-from pathlib import Path
+import random
+import tarfile
+import time
+from pathlib import Path, PurePosixPath
 from datetime import datetime
 
 import pytest
@@ -24,6 +27,14 @@ def test_build_archive_name_extensions():
     assert m.build_archive_name(now, "none").endswith(".tar")
 
 
+def test_human_size():
+    assert m.human_size(0) == "0.0B"
+    assert m.human_size(1023) == "1023.0B"
+    assert m.human_size(1536) == "1.5KB"
+    assert m.human_size(5 * 1024**3 + 1) == "5.0GB"
+    assert m.human_size(3 * 1024**5) == "3072.0TB"
+
+
 def test_enumerate_exclusions(tmp_path: Path):
     log_dir, output_dir = create_sample_tree(tmp_path)
     # Create audit log inside output dir which must be excluded
@@ -44,6 +55,79 @@ def test_enumerate_exclusions(tmp_path: Path):
     assert "archives" not in {p.name for p in files if p.is_dir()}
 
 
+def test_enumerate_nested(tmp_path: Path):
+    log_dir, output_dir = create_sample_tree(tmp_path)
+    (log_dir / "nginx" / "old").mkdir(parents=True)
+    (log_dir / "nginx" / "access.log").write_text("gamma\n", encoding="utf-8")
+    (log_dir / "nginx" / "old" / "access.log.1").write_text("delta\n", encoding="utf-8")
+    (output_dir / "stale.log").write_text("skip\n", encoding="utf-8")
+    files = m.enumerate_files(log_dir, output_dir, output_dir / m.AUDIT_LOG_NAME, [], [])
+    rels = {p.relative_to(log_dir).as_posix() for p in files}
+    assert rels == {"app.log", "system.log", "nginx/access.log", "nginx/old/access.log.1"}
+
+
+def test_enumerate_many_subdirs(tmp_path: Path):
+    log_dir, output_dir = create_sample_tree(tmp_path)
+    expected = {"app.log", "system.log"}
+    for i in range(m.PARALLEL_WALK_MIN_DIRS + 3):
+        sub = log_dir / f"svc{i}" / "nested"
+        sub.mkdir(parents=True)
+        (sub / "out.log").write_text(f"{i}\n", encoding="utf-8")
+        expected.add(f"svc{i}/nested/out.log")
+    files = m.enumerate_files(log_dir, output_dir, output_dir / m.AUDIT_LOG_NAME, [], [])
+    assert {p.relative_to(log_dir).as_posix() for p in files} == expected
+
+
+def test_compile_matcher_follows_path_match():
+    is_excluded = m.compile_matcher(["*.log", "nginx/*"], ["debug/*.log"])
+    assert not is_excluded("app.log")
+    assert not is_excluded("svc/deep/app.log")
+    assert not is_excluded("nginx/access.gz")
+    assert is_excluded("nginx/old/access.gz")  # "*" does not cross "/"
+    assert is_excluded("debug/trace.log")
+    assert is_excluded("notes.txt")
+    assert not m.compile_matcher([], [])("anything")
+    # A leading "]" in a bracket expression is literal, negated or not
+    assert not m.compile_matcher(["[!]]x"], [])("zx")
+    assert m.compile_matcher(["[!]]x"], [])("]x")
+    assert not m.compile_matcher(["[]a]x"], [])("]x")
+    # "-" right after "!" is literal; reversed ranges match nothing instead of failing
+    assert not m.compile_matcher(["[!-a].log"], [])("Z.log")
+    assert m.compile_matcher(["[!-a].log"], [])("-.log")
+    assert m.compile_matcher(["[z-a].log"], [])("a.log")
+
+
+def test_compile_matcher_randomized_against_path_match():
+    rng = random.Random(20250101)
+    chars = "ab-!^]\\[&~|.Z5z"
+    for _ in range(5000):
+        pat = "".join(rng.choice(chars + "*?/") for _ in range(rng.randint(1, 7))).strip("/") or "a"
+        parts = ["".join(rng.choice(chars) for _ in range(rng.randint(1, 3))) for _ in range(rng.randint(1, 3))]
+        if "." in parts or ".." in parts:
+            continue  # never produced by the walker, and normalized away by PurePath
+        rel = "/".join(parts)
+        try:
+            expected = PurePosixPath(rel).match(pat)
+        except ValueError:
+            continue
+        assert (not m.compile_matcher([pat], [])(rel)) == expected, (pat, rel)
+
+
+def test_enumerate_anchored_include_prefix(tmp_path: Path):
+    log_dir, output_dir = create_sample_tree(tmp_path)
+    for rel in ["access/a.log", "access/errors/e.log", "other/access/x.log", "other/b.log"]:
+        (log_dir / rel).parent.mkdir(parents=True, exist_ok=True)
+        (log_dir / rel).write_text("x\n", encoding="utf-8")
+    patterns = ["/access/*.log", "/access/errors/*.log"]
+    assert m.include_prefix(patterns) == ["access"]
+    files = m.enumerate_files(log_dir, output_dir, output_dir / m.AUDIT_LOG_NAME, patterns, [])
+    assert {p.relative_to(log_dir).as_posix() for p in files} == {"access/a.log", "access/errors/e.log"}
+    # Relative patterns match at any depth, so they must not prune the walk
+    files = m.enumerate_files(log_dir, output_dir, output_dir / m.AUDIT_LOG_NAME, ["access/*.log"], [])
+    assert {p.relative_to(log_dir).as_posix() for p in files} == {"access/a.log", "other/access/x.log"}
+    assert m.enumerate_files(log_dir, output_dir, output_dir / m.AUDIT_LOG_NAME, ["/missing/*.log"], []) == []
+
+
 def test_create_archive_none_and_count(tmp_path: Path):
     log_dir, output_dir = create_sample_tree(tmp_path)
     audit_log_path = output_dir / m.AUDIT_LOG_NAME
@@ -51,7 +135,7 @@ def test_create_archive_none_and_count(tmp_path: Path):
 
     archive_name = m.build_archive_name(datetime.now(), "none")
     dest = output_dir / archive_name
-    duration_ms = m.create_archive(
+    duration_ms, file_count, size_bytes = m.create_archive(
         source_root=log_dir,
         files=files,
         dest_archive=dest,
@@ -62,9 +146,101 @@ def test_create_archive_none_and_count(tmp_path: Path):
     )
     assert dest.exists(), "archive should be created"
     assert duration_ms >= 0
+    assert file_count == len(files)
     count, size = m.compute_file_count_and_size(dest)
-    assert count == len(files)
-    assert size > 0
+    assert count == file_count
+    assert size == size_bytes == dest.stat().st_size
+
+
+def test_create_archive_none_without_sendfile(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(m.sys, "platform", "darwin")
+    log_dir, output_dir = create_sample_tree(tmp_path)
+    files = m.enumerate_files(log_dir, output_dir, output_dir / m.AUDIT_LOG_NAME, [], [])
+    dest = output_dir / m.build_archive_name(datetime.now(), "none")
+    _, file_count, size_bytes = m.create_archive(log_dir, files, dest, "none", None, 1, False)
+    assert file_count == len(files)
+    assert size_bytes == dest.stat().st_size
+    assert m.compute_file_count_and_size(dest)[0] == len(files)
+
+
+def test_create_archive_mixed_members(tmp_path: Path):
+    log_dir, output_dir = create_sample_tree(tmp_path)
+    big = b"x" * (m.PREFETCH_MAX_BYTES + 1)
+    (log_dir / "big.log").write_bytes(big)
+    os.symlink("app.log", log_dir / "current.log")
+    os.link(log_dir / "system.log", log_dir / "system.log.1")
+    files = m.enumerate_files(log_dir, output_dir, output_dir / m.AUDIT_LOG_NAME, [], [])
+    dest = output_dir / m.build_archive_name(datetime.now(), "none")
+    _, file_count, _ = m.create_archive(log_dir, files, dest, "none", None, 1, False)
+    assert file_count == len(files) == 5
+    with tarfile.open(dest) as tar:
+        members = {ti.name: ti for ti in tar}
+        assert tar.extractfile("big.log").read() == big
+        assert tar.extractfile("app.log").read() == b"alpha\n"
+    assert members["current.log"].issym() and members["current.log"].linkname == "app.log"
+    linked = [ti for ti in members.values() if ti.islnk()]
+    assert len(linked) == 1 and linked[0].linkname in {"system.log", "system.log.1"}
+
+
+@pytest.mark.parametrize("compression", ["none", "gzip"])
+def test_create_archive_dedup_hardlinks(tmp_path: Path, compression: str):
+    log_dir, output_dir = create_sample_tree(tmp_path)
+    (log_dir / "app.log.1").write_text("alpha\n", encoding="utf-8")
+    (log_dir / "empty.log").write_bytes(b"")
+    (log_dir / "empty.log.1").write_bytes(b"")
+    # Same size and same ends, different middle: must not be linked
+    probe = m.DEDUP_PROBE_BYTES
+    (log_dir / "big.log").write_bytes(b"a" * probe + b"X" + b"z" * probe)
+    (log_dir / "big.log.1").write_bytes(b"a" * probe + b"Y" + b"z" * probe)
+    files = sorted(m.enumerate_files(log_dir, output_dir, output_dir / m.AUDIT_LOG_NAME, [], []))
+    duplicates = m.find_duplicates(files)
+    assert {dup: entry[0] for dup, entry in duplicates.items()} == {log_dir / "app.log.1": log_dir / "app.log"}
+
+    dest = output_dir / m.build_archive_name(datetime.now(), compression)
+    m.create_archive(log_dir, files, dest, compression, None, 1, False, duplicates=duplicates)
+    with tarfile.open(dest) as tar:
+        members = {ti.name: ti for ti in tar}
+        assert members["app.log.1"].islnk() and members["app.log.1"].linkname == "app.log"
+        assert tar.extractfile("app.log.1").read() == b"alpha\n"
+        assert members["big.log.1"].isreg()
+
+
+def test_verify_archive_zstd_unreadable(tmp_path: Path, monkeypatch: pytest.MonkeyPatch, capsys: pytest.CaptureFixture):
+    pytest.importorskip("zstandard")
+    log_dir, output_dir = create_sample_tree(tmp_path)
+    files = m.enumerate_files(log_dir, output_dir, output_dir / m.AUDIT_LOG_NAME, [], [])
+    dest = output_dir / m.build_archive_name(datetime.now(), "zstd")
+    m.create_archive(log_dir, files, dest, "zstd", None, 1, False)
+    assert m.verify_archive(dest, len(files))
+    with pytest.raises(ValueError):
+        m.verify_archive(dest, len(files) + 1)
+    # Without any zstd reader a valid archive is skipped, not reported as corrupt
+    monkeypatch.setattr(m, "zstandard", None)
+    monkeypatch.setattr(m.shutil, "which", lambda name: None)
+    assert m.verify_archive(dest, len(files)) is False
+    assert "cannot verify" in capsys.readouterr().err
+
+
+@pytest.mark.parametrize("compression", ["none", "gzip"])
+@pytest.mark.parametrize("changed", ["app.log", "app.log.1"])
+def test_create_archive_dedup_file_changed(tmp_path: Path, compression: str, changed: str):
+    log_dir, output_dir = create_sample_tree(tmp_path)
+    (log_dir / "app.log.1").write_text("alpha\n", encoding="utf-8")
+    files = sorted(m.enumerate_files(log_dir, output_dir, output_dir / m.AUDIT_LOG_NAME, [], []))
+    duplicates = m.find_duplicates(files)
+    assert log_dir / "app.log.1" in duplicates
+    # A live log grows after hashing but before it is archived
+    with (log_dir / changed).open("a", encoding="utf-8") as fh:
+        fh.write("line2\n")
+
+    dest = output_dir / m.build_archive_name(datetime.now(), compression)
+    m.create_archive(log_dir, files, dest, compression, None, 1, False, duplicates=duplicates)
+    with tarfile.open(dest) as tar:
+        assert not any(ti.islnk() for ti in tar.getmembers())
+        expected = {"app.log": b"alpha\n", "app.log.1": b"alpha\n"}
+        expected[changed] += b"line2\n"
+        for name, content in expected.items():
+            assert tar.extractfile(name).read() == content
 
 
 def test_incremental_two_runs(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
@@ -82,6 +258,25 @@ def test_incremental_two_runs(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
     assert len(after) >= len(before)
 
 
+def test_main_verify(tmp_path: Path):
+    log_dir, output_dir = create_sample_tree(tmp_path)
+    assert m.main([str(log_dir), "--compression", "gzip", "--verify"]) == 0
+    audit = (output_dir / m.AUDIT_LOG_NAME).read_text(encoding="utf-8")
+    assert "files=2" in audit and "ERROR" not in audit
+
+
+def test_incremental_skips_unchanged(tmp_path: Path):
+    log_dir, output_dir = create_sample_tree(tmp_path)
+    assert m.main([str(log_dir), "--compression", "none", "--incremental"]) == 0
+    manifest = m.load_manifest(output_dir / m.MANIFEST_NAME)
+    assert set(manifest) == {"app.log", "system.log"}
+
+    (log_dir / "app.log").write_text("alpha\nmore\n", encoding="utf-8")
+    files = m.enumerate_files(log_dir, output_dir, output_dir / m.AUDIT_LOG_NAME, [], [], previous=manifest)
+    assert [p.name for p in files] == ["app.log"]
+    assert not (output_dir / (m.MANIFEST_NAME + ".tmp")).exists()
+
+
 def test_retention_count(tmp_path: Path):
     log_dir, output_dir = create_sample_tree(tmp_path)
     audit_log_path = output_dir / m.AUDIT_LOG_NAME
@@ -96,3 +291,166 @@ def test_retention_count(tmp_path: Path):
     m.apply_retention(output_dir, retention_days=None, retention_count=1, dry_run=False, verbose=False)
     remaining = sorted([p for p in output_dir.glob("*.tar")])
     assert len(remaining) == 1
+
+
+@pytest.mark.parametrize("level", [None, 6])
+def test_create_archive_gzip_stream(tmp_path: Path, level):
+    log_dir, output_dir = create_sample_tree(tmp_path)
+    audit_log_path = output_dir / m.AUDIT_LOG_NAME
+    files = m.enumerate_files(log_dir, output_dir, audit_log_path, [], [])
+    dest = output_dir / m.build_archive_name(datetime.now(), "gzip")
+    m.create_archive(log_dir, files, dest, "gzip", level, 1, False)
+    count, _ = m.compute_file_count_and_size(dest)
+    assert count == len(files)
+
+
+def test_create_archive_zstd_stream(tmp_path: Path):
+    zstandard = pytest.importorskip("zstandard")
+    log_dir, output_dir = create_sample_tree(tmp_path)
+    audit_log_path = output_dir / m.AUDIT_LOG_NAME
+    files = m.enumerate_files(log_dir, output_dir, audit_log_path, [], [])
+    dest = output_dir / m.build_archive_name(datetime.now(), "zstd")
+    _, _, size_bytes = m.create_archive(log_dir, files, dest, "zstd", None, 0, False)
+    assert size_bytes == dest.stat().st_size
+    assert m.compute_file_count_and_size(dest)[0] == len(files)
+    with dest.open("rb") as fh, zstandard.ZstdDecompressor().stream_reader(fh) as reader:
+        with tarfile.open(fileobj=reader, mode="r|") as tar:
+            names = {ti.name for ti in tar}
+    assert names == {"app.log", "system.log"}
+
+
+def test_create_archive_gzip_threads_without_pigz(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(m.shutil, "which", lambda name: None)
+    log_dir, output_dir = create_sample_tree(tmp_path)
+    audit_log_path = output_dir / m.AUDIT_LOG_NAME
+    files = m.enumerate_files(log_dir, output_dir, audit_log_path, [], [])
+    dest = output_dir / m.build_archive_name(datetime.now(), "gzip")
+    m.create_archive(log_dir, files, dest, "gzip", None, 4, False)
+    count, _ = m.compute_file_count_and_size(dest)
+    assert count == len(files)
+
+
+def create_old_archives(output_dir: Path, count: int) -> None:
+    for day in range(1, count + 1):
+        p = output_dir / f"{m.ARCHIVE_PREFIX}2025010{day}_000000.tar"
+        p.write_bytes(b"")
+        os.utime(p, (day, day))
+
+
+def test_main_background_retention(tmp_path: Path):
+    log_dir, output_dir = create_sample_tree(tmp_path)
+    create_old_archives(output_dir, 3)
+    assert m.main([str(log_dir), "--compression", "none", "--retention-count", "2", "--sha256"]) == 0
+    # main waits for the retention worker before returning
+    assert len(list(output_dir.glob(f"{m.ARCHIVE_PREFIX}*.tar"))) == 2
+
+
+@pytest.mark.parametrize("verbose", [[], ["--verbose"]])
+def test_main_retention_with_gpg_encrypt(tmp_path: Path, monkeypatch: pytest.MonkeyPatch, verbose: list[str]):
+    def fake_encrypt(src: Path, recipients, verbose):
+        time.sleep(0.1)  # give an early retention scan time to see the plaintext
+        enc = src.with_suffix(src.suffix + ".gpg")
+        src.rename(enc)
+        return enc
+
+    def fake_sign(src: Path, verbose):
+        sig = src.with_suffix(src.suffix + ".sig")
+        sig.write_bytes(b"sig")
+        return sig
+
+    monkeypatch.setattr(m, "run_gpg_encrypt", fake_encrypt)
+    monkeypatch.setattr(m, "run_gpg_sign", fake_sign)
+    log_dir, output_dir = create_sample_tree(tmp_path)
+    create_old_archives(output_dir, 3)
+    argv = [str(log_dir), "--compression", "none", "--retention-count", "2", "--sha256",
+            "--gpg-encrypt", "--gpg-recipients", "ops@example.com", "--gpg-sign"] + verbose
+    assert m.main(argv) == 0
+    # The encrypted archive is not a retention candidate, so both newest plain archives stay
+    remaining = sorted(p.name for p in output_dir.glob(f"{m.ARCHIVE_PREFIX}*.tar"))
+    assert remaining == [f"{m.ARCHIVE_PREFIX}20250102_000000.tar", f"{m.ARCHIVE_PREFIX}20250103_000000.tar"]
+
+
+def test_main_background_retention_error(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    def failing_retention(*args, **kwargs):
+        raise OSError("disk on fire")
+
+    monkeypatch.setattr(m, "apply_retention", failing_retention)
+    log_dir, output_dir = create_sample_tree(tmp_path)
+    assert m.main([str(log_dir), "--compression", "none", "--retention-count", "1"]) == 1
+    audit = (output_dir / m.AUDIT_LOG_NAME).read_text(encoding="utf-8")
+    assert "ERROR=disk on fire" in audit
+
+
+def test_retention_days_uses_mtime(tmp_path: Path):
+    output_dir = tmp_path / "archives"
+    output_dir.mkdir()
+    now = datetime.now().timestamp()
+    for i, ext in enumerate([".tar", ".tar.gz", ".tar.zst"]):
+        p = output_dir / f"{m.ARCHIVE_PREFIX}2025010{i}_000000{ext}"
+        p.write_bytes(b"")
+        age_days = 10 - i * 4  # 10, 6 and 2 days old
+        os.utime(p, (now - age_days * 86400, now - age_days * 86400))
+    (output_dir / m.AUDIT_LOG_NAME).write_text("audit\n", encoding="utf-8")
+    m.apply_retention(output_dir, retention_days=5, retention_count=None, dry_run=False, verbose=False)
+    remaining = sorted(p.name for p in output_dir.iterdir())
+    assert remaining == [m.AUDIT_LOG_NAME, f"{m.ARCHIVE_PREFIX}20250102_000000.tar.zst"]
+
+
+def test_retention_skips_vanished_archive(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    output_dir = tmp_path / "archives"
+    output_dir.mkdir()
+    create_old_archives(output_dir, 3)
+    vanished = output_dir / f"{m.ARCHIVE_PREFIX}20250101_000000.tar"
+    real_scandir = os.scandir
+
+    class VanishingScandir:
+        def __init__(self, path):
+            self._it = real_scandir(path)
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc):
+            self._it.close()
+
+        def __iter__(self):
+            for entry in self._it:
+                if entry.path == str(vanished):
+                    # Deleted by someone else after it was listed
+                    os.unlink(entry.path)
+                yield entry
+
+    monkeypatch.setattr(m.os, "scandir", VanishingScandir)
+    m.apply_retention(output_dir, retention_days=None, retention_count=1, dry_run=False, verbose=False)
+    assert [p.name for p in output_dir.iterdir()] == [f"{m.ARCHIVE_PREFIX}20250103_000000.tar"]
+
+
+def test_main_audit_log_open_error(tmp_path: Path, capsys: pytest.CaptureFixture[str]):
+    log_dir, output_dir = create_sample_tree(tmp_path)
+    (output_dir / m.AUDIT_LOG_NAME).mkdir()
+    assert m.main([str(log_dir), "--compression", "none"]) == 1
+    assert capsys.readouterr().err.startswith("Error: ")
+
+
+def test_audit_log_appends_lines(tmp_path: Path):
+    path = tmp_path / m.AUDIT_LOG_NAME
+    now = datetime(2025, 1, 2, 3, 4, 5)
+    with m.AuditLog(path) as audit:
+        audit.write(now, "a.tar", 2, 2048, 7)
+        audit.write(now, "b.tar", 0, 0, 0, error="boom")
+    m.write_audit_line(path, now, "c.tar", 1, 10, 1)
+    lines = path.read_text(encoding="utf-8").splitlines()
+    assert lines[0].endswith("archive=a.tar | files=2 | size=2.0KB | duration_ms=7")
+    assert lines[1].endswith("archive=b.tar | ERROR=boom")
+    assert "archive=c.tar" in lines[2]
+
+
+def test_load_config_from_env(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    cfg = tmp_path / "config.toml"
+    cfg.write_text('retention_count = 3\ninclude = ["*.log"]\n', encoding="utf-8")
+    monkeypatch.setenv("LOG_ARCHIVE_CONFIG", str(cfg))
+    assert m.load_config(None) == {"retention_count": 3, "include": ["*.log"]}
+    monkeypatch.setenv("LOG_ARCHIVE_CONFIG", str(tmp_path / "missing.toml"))
+    monkeypatch.setenv("XDG_CONFIG_HOME", str(tmp_path / "xdg"))
+    monkeypatch.setenv("HOME", str(tmp_path))
+    assert m.load_config(None) == {}